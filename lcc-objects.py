@@ -1,8 +1,32 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from functools import partial
+from array import array
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from operator import attrgetter, itemgetter
+import csv
+import heapq
 import json
 import math
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 from enum import Enum
+from fractions import Fraction
 from graphviz import Digraph
+try:
+    import numpy
+except ImportError:  # optional, only speeds up ratio_bps
+    numpy = None
 
 class LinkType(Enum):
     DIRECT = 1
@@ -37,14 +61,25 @@ class Node:
     residual_categorisation_value: int
     
 class NodeTree:
+    VALUE_FIELDS = ('original_bank_value', 'original_market_value', 'original_categorisation_value',
+                    'residual_bank_value', 'residual_market_value', 'residual_categorisation_value')
+    # Derived values that can be queried like fields: original - residual
+    SHORTFALL_FIELDS = {
+        'bank_value_shortfall': ('original_bank_value', 'residual_bank_value'),
+        'market_value_shortfall': ('original_market_value', 'residual_market_value'),
+        'categorisation_value_shortfall': ('original_categorisation_value', 'residual_categorisation_value'),
+    }
+    
     def __init__(self):
         self.tree = dict()
+        self._indexes = dict()  # (field, node type, quadrant) or ratio key -> (sorted values, nodes in the same order)
         
     def add_node_at_quadrant(self, node: Node, quadrant: int):
         try:
             self.tree[quadrant][node.id] = node
         except KeyError:
             self.tree[quadrant] = {node.id: node}
+        self._indexes.clear()
     
     def get_node_at_quadrant(self, id: str,quadrant: int):
         node = None
@@ -63,6 +98,106 @@ class NodeTree:
             res = list(self.tree.get(quadrant).values())
         return res
     
+    def update_node(self, id: str, quadrant: int, **values):
+        """Sets field values on a node and drops the query indexes built over the old values."""
+        node = self.get_node_at_quadrant(id, quadrant)
+        # Check every name before changing anything, so a bad name leaves the node as it was
+        for name in values:
+            if name not in self.VALUE_FIELDS and name != 'type':
+                raise ValueError(f"Cannot update field {name} of node {id}")
+        try:
+            for name, value in values.items():
+                setattr(node, name, value)
+        finally:
+            self._indexes.clear()
+        return node
+    
+    def invalidate_indexes(self):
+        """Call after changing Node objects directly instead of through update_node."""
+        self._indexes.clear()
+    
+    def _value_getter(self, field: str):
+        if field in self.VALUE_FIELDS:
+            return attrgetter(field)
+        if field in self.SHORTFALL_FIELDS:
+            original, residual = (attrgetter(name) for name in self.SHORTFALL_FIELDS[field])
+            return lambda node: original(node) - residual(node)
+        raise ValueError(f"Unknown node value field {field}")
+    
+    def _nodes(self, node_type, quadrant):
+        if quadrant is not None:
+            nodes = self.get_quadrant_nodes(quadrant)
+        else:
+            # The same Node can sit in several quadrants, count it once
+            nodes = list({id(node): node for quadrant_nodes in self.tree.values() for node in quadrant_nodes.values()}.values())
+        if node_type is not None:
+            nodes = [node for node in nodes if node.type == node_type]
+        return nodes
+    
+    def _index(self, field: str, node_type, quadrant):
+        key = (field, node_type, quadrant)
+        index = self._indexes.get(key)
+        if index is None:
+            getter = self._value_getter(field)
+            nodes = sorted(self._nodes(node_type, quadrant), key=getter)
+            index = self._indexes[key] = (list(map(getter, nodes)), nodes)
+        return index
+    
+    def _bounds(self, values: list, low, high):
+        start = 0 if low is None else bisect_left(values, low)
+        end = len(values) if high is None else bisect_left(values, high)
+        return start, max(start, end)
+    
+    def query_range(self, field: str, low=None, high=None, node_type: str = None, quadrant: int = None) -> list[Node]:
+        """Nodes with low <= field < high (either bound may be None), in ascending order of field."""
+        values, nodes = self._index(field, node_type, quadrant)
+        start, end = self._bounds(values, low, high)
+        return nodes[start:end]
+    
+    def count_range(self, field: str, low=None, high=None, node_type: str = None, quadrant: int = None) -> int:
+        values, _ = self._index(field, node_type, quadrant)
+        start, end = self._bounds(values, low, high)
+        return end - start
+    
+    def top_k(self, field: str, k: int, node_type: str = None, quadrant: int = None, largest: bool = True) -> list[Node]:
+        """The k nodes with the largest (or smallest) field value, e.g. top_k('bank_value_shortfall', 100, 'PRODUCT')."""
+        _, nodes = self._index(field, node_type, quadrant)
+        if k <= 0:
+            return []
+        if largest:
+            return nodes[-k:][::-1]
+        return nodes[:k]
+    
+    def _ratio_index(self, numerator: str, denominator: str, node_type, quadrant):
+        key = ('ratio', numerator, denominator, node_type, quadrant)
+        index = self._indexes.get(key)
+        if index is None:
+            numerator_of = self._value_getter(numerator)
+            denominator_of = self._value_getter(denominator)
+            # Exact ratios, so a threshold like 0.1 is not subject to float rounding
+            ratios = sorted(
+                ((Fraction(numerator_of(node), denominator_of(node)), node)
+                 for node in self._nodes(node_type, quadrant) if denominator_of(node)),
+                key=itemgetter(0))
+            index = self._indexes[key] = ([ratio for ratio, _ in ratios], [node for _, node in ratios])
+        return index
+    
+    def query_ratio(self, numerator: str, denominator: str, below, node_type: str = None, quadrant: int = None) -> list[Node]:
+        """
+        Nodes where numerator / denominator < below, in ascending order of the ratio, e.g.
+        query_ratio('residual_market_value', 'original_market_value', 0.1, 'CHARGE').
+        Nodes with a zero denominator are skipped. A float threshold is read as its decimal
+        text (0.1 means exactly 1/10).
+        """
+        ratios, nodes = self._ratio_index(numerator, denominator, node_type, quadrant)
+        threshold = Fraction(str(below)) if isinstance(below, float) else Fraction(below)
+        return nodes[:bisect_left(ratios, threshold)]
+    
+    def count_ratio(self, numerator: str, denominator: str, below, node_type: str = None, quadrant: int = None) -> int:
+        ratios, _ = self._ratio_index(numerator, denominator, node_type, quadrant)
+        threshold = Fraction(str(below)) if isinstance(below, float) else Fraction(below)
+        return bisect_left(ratios, threshold)
+    
 @dataclass
 class Intersection:
     upper_node: Node
@@ -74,6 +209,279 @@ class Intersection:
     priority_table_order: int
     
     
+NODE_FIELDS = tuple(f.name for f in fields(Node))
+
+class NodeConflictError(ValueError):
+    def __init__(self, node_id: str, differences: dict):
+        self.node_id = node_id
+        self.differences = differences  # field -> (registered value, new value)
+        details = ", ".join(f"{name}: {a!r} != {b!r}" for name, (a, b) in differences.items())
+        super().__init__(f"Node {node_id} registered with different values ({details})")
+
+class NodeRegistry:
+    """
+    Hands out one canonical Node per id, so every intersection that refers to an id
+    shares the same object and residual updates are seen everywhere.
+    """
+    def __init__(self):
+        self.nodes = dict()
+        self._values = attrgetter(*NODE_FIELDS)
+    
+    def register(self, node: Node) -> Node:
+        """Returns the canonical Node for node.id, raising NodeConflictError if the values differ."""
+        existing = self.nodes.get(node.id)
+        if existing is None:
+            self.nodes[node.id] = node
+            return node
+        if existing is not node:
+            old_values = self._values(existing)
+            new_values = self._values(node)
+            if old_values != new_values:
+                raise NodeConflictError(node.id, {
+                    name: (a, b) for name, a, b in zip(NODE_FIELDS, old_values, new_values) if a != b
+                })
+        return existing
+    
+    def get(self, id: str):
+        return self.nodes.get(id)
+    
+    def __contains__(self, id: str) -> bool:
+        return id in self.nodes
+    
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+def canonicalize_intersections(intersection_list: list[Intersection], registry: NodeRegistry = None) -> NodeRegistry:
+    """
+    Replaces the nodes of each intersection in place with the registry's canonical instances.
+    Every node is registered before any intersection is changed, so on NodeConflictError
+    neither the list nor the registry is modified.
+    Args:
+        intersection_list: List of Intersection objects
+        registry: Registry to use, a new one if None
+    Returns:
+        The registry holding the canonical nodes
+    """
+    if registry is None:
+        registry = NodeRegistry()
+    added = []  # ids first registered by this call, removed again on conflict
+    canonical = []
+    try:
+        for intersection in intersection_list:
+            for node in (intersection.upper_node, intersection.lower_node):
+                if node.id not in registry:
+                    added.append(node.id)
+                canonical.append(registry.register(node))
+    except NodeConflictError:
+        for node_id in added:
+            del registry.nodes[node_id]
+        raise
+    
+    canonical = iter(canonical)
+    for intersection in intersection_list:
+        intersection.upper_node = next(canonical)
+        intersection.lower_node = next(canonical)
+    return registry
+
+INTERSECTION_TABLE_MAGIC = b'LCCI'
+NODE_INT_FIELDS = NODE_FIELDS[2:]  # the six value fields after id and type
+
+class IntersectionRow:
+    """
+    View of one row of an IntersectionTable with the same attributes as Intersection,
+    read from the table's columns on access.
+    """
+    __slots__ = ('table', 'row')
+    
+    def __init__(self, table, row: int):
+        self.table = table
+        self.row = row
+    
+    @property
+    def upper_node(self) -> Node:
+        return self.table.nodes[self.table.upper[self.row]]
+    
+    @property
+    def lower_node(self) -> Node:
+        return self.table.nodes[self.table.lower[self.row]]
+    
+    @property
+    def quadrant_number(self) -> int:
+        return self.table.quadrant_number[self.row]
+    
+    @property
+    def link_type(self) -> int:
+        return self.table.link_type[self.row]
+    
+    @property
+    def number_of_intersections(self) -> int:
+        return self.table.number_of_intersections[self.row]
+    
+    @property
+    def process_order(self) -> int:
+        return self.table.process_order[self.row]
+    
+    @property
+    def priority_table_order(self) -> int:
+        return self.table.priority_table_order[self.row]
+    
+    def link_type_enum(self) -> LinkType:
+        return LinkType(self.link_type)
+
+class IntersectionTable:
+    """
+    Intersection list stored as parallel arrays. Each node is stored once (canonical, through a
+    NodeRegistry) and links refer to it by index, so a link costs a few fixed-width ints instead
+    of an Intersection object. export_intersections (and so print_tree and output_json, through
+    ExportSink.visit_row), LazyTreeView and allocate_by_quadrant read the columns directly and
+    create no per-link objects; so do cursor() and loops over the columns themselves. Indexing
+    or iterating creates an IntersectionRow view per link, for code written against
+    Intersection attributes.
+    """
+    def __init__(self):
+        self.registry = NodeRegistry()
+        self.nodes = []  # node index -> Node
+        self.node_index = {}  # node id -> node index
+        self.upper = array('i')
+        self.lower = array('i')
+        self.quadrant_number = array('q')
+        self.link_type = array('b')
+        self.number_of_intersections = array('q')
+        self.process_order = array('q')
+        self.priority_table_order = array('q')
+    
+    def __len__(self) -> int:
+        return len(self.upper)
+    
+    def __getitem__(self, row: int) -> IntersectionRow:
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f"Row {row} out of range")
+        return IntersectionRow(self, row)
+    
+    def __iter__(self):
+        for row in range(len(self)):
+            yield IntersectionRow(self, row)
+    
+    def cursor(self):
+        """Yields the same IntersectionRow moved from row to row; don't keep references to it."""
+        view = IntersectionRow(self, 0)
+        for row in range(len(self)):
+            view.row = row
+            yield view
+    
+    def add_node(self, node: Node) -> int:
+        node = self.registry.register(node)
+        index = self.node_index.get(node.id)
+        if index is None:
+            index = self.node_index[node.id] = len(self.nodes)
+            self.nodes.append(node)
+        return index
+    
+    def append(self, upper_node: Node, lower_node: Node, quadrant_number: int, link_type, number_of_intersections: int,
+               process_order: int, priority_table_order: int):
+        link_type = getattr(link_type, 'value', link_type)
+        if link_type not in LINK_TYPE_VALUES:
+            raise ValueError(f"Unknown link type {link_type!r}")
+        self.upper.append(self.add_node(upper_node))
+        self.lower.append(self.add_node(lower_node))
+        self.quadrant_number.append(quadrant_number)
+        self.link_type.append(link_type)
+        self.number_of_intersections.append(number_of_intersections)
+        self.process_order.append(process_order)
+        self.priority_table_order.append(priority_table_order)
+    
+    def rows_by_quadrant(self) -> dict:
+        """Quadrant -> array of row numbers in list order, lowest quadrant first."""
+        rows = {}
+        for row, quadrant in enumerate(self.quadrant_number):
+            try:
+                rows[quadrant].append(row)
+            except KeyError:
+                rows[quadrant] = array('q', [row])
+        return dict(sorted(rows.items()))
+    
+    def to_intersections(self) -> list[Intersection]:
+        return [
+            Intersection(upper_node=row.upper_node, lower_node=row.lower_node, quadrant_number=row.quadrant_number,
+                         link_type=row.link_type, number_of_intersections=row.number_of_intersections,
+                         process_order=row.process_order, priority_table_order=row.priority_table_order)
+            for row in self
+        ]
+    
+    @classmethod
+    def from_intersections(cls, intersection_list: list[Intersection]):
+        table = cls()
+        for intersection in intersection_list:
+            table.append(intersection.upper_node, intersection.lower_node, intersection.quadrant_number,
+                         intersection.link_type, intersection.number_of_intersections,
+                         intersection.process_order, intersection.priority_table_order)
+        return table
+    
+    @classmethod
+    def from_records(cls, records: list[dict]):
+        """Builds a table from intersection_to_record dicts, e.g. json.loads of a shard file line."""
+        table = cls()
+        for record in records:
+            table.append(Node(**record['upper_node']), Node(**record['lower_node']), record['quadrant_number'],
+                         record['link_type'], record['number_of_intersections'],
+                         record['process_order'], record['priority_table_order'])
+        return table
+    
+    @classmethod
+    def from_json(cls, text: str):
+        return cls.from_records(json.loads(text))
+    
+    def write_binary(self, out):
+        """
+        Writes the table to a binary stream (little-endian):
+            magic 'LCCI', int64 node count, int64 link count,
+            node id and type columns (write_text_column), six int64 node value columns,
+            int32 upper and lower node indexes, int64 quadrant, int8 link type, three int64 order columns
+        """
+        out.write(INTERSECTION_TABLE_MAGIC + struct.pack('<qq', len(self.nodes), len(self)))
+        write_text_column(out, [node.id for node in self.nodes])
+        write_text_column(out, [node.type for node in self.nodes])
+        for name in NODE_INT_FIELDS:
+            write_int_column(out, map(attrgetter(name), self.nodes))
+        write_int_column(out, self.upper, 'i')
+        write_int_column(out, self.lower, 'i')
+        write_int_column(out, self.quadrant_number)
+        write_int_column(out, self.link_type, 'b')
+        write_int_column(out, self.number_of_intersections)
+        write_int_column(out, self.process_order)
+        write_int_column(out, self.priority_table_order)
+    
+    @classmethod
+    def read_binary(cls, f):
+        header = f.read(20)
+        if header[:4] != INTERSECTION_TABLE_MAGIC:
+            raise ValueError("Not an intersection table")
+        node_count, link_count = struct.unpack('<qq', header[4:])
+        
+        table = cls()
+        ids = read_text_column(f, node_count)
+        types = read_text_column(f, node_count)
+        values = [read_int_column(f, node_count) for _ in NODE_INT_FIELDS]
+        for node_id, node_type, *node_values in zip(ids, types, *values):
+            table.add_node(Node(node_id, node_type, *node_values))
+        
+        table.upper = read_int_column(f, link_count, 'i')
+        table.lower = read_int_column(f, link_count, 'i')
+        table.quadrant_number = read_int_column(f, link_count)
+        table.link_type = read_int_column(f, link_count, 'b')
+        table.number_of_intersections = read_int_column(f, link_count)
+        table.process_order = read_int_column(f, link_count)
+        table.priority_table_order = read_int_column(f, link_count)
+        # A repeated id is merged into one node, which would shift every later node index
+        if len(table.nodes) != node_count:
+            raise ValueError("Intersection table repeats a node id")
+        if any(index >= len(table.nodes) or index < 0 for index in (max(table.upper, default=0), min(table.upper, default=0),
+                                                                   max(table.lower, default=0), min(table.lower, default=0))):
+            raise ValueError("Intersection table refers to a node index out of range")
+        return table
+
 test = {
     "indirect": [1,2,3],
     "direct": [4,5,6]
@@ -85,8 +493,9 @@ for key in test:
 test = filtered_test
 
 
+node_registry = NodeRegistry()
 intersection_list = [
-    Intersection(upper_node=Node(id = '1-2KDVAPB',
+    Intersection(upper_node=node_registry.register(Node(id = '1-2KDVAPB',
 type = 'CHARGE',
 original_bank_value = 15000,
 original_market_value = 30000,
@@ -94,36 +503,36 @@ original_categorisation_value = 45000,
 residual_bank_value = 15000,
 residual_market_value = 30000,
 residual_categorisation_value = 4500 
-                                 ),
-                 lower_node=Node(id = 'test',
+                                 )),
+                 lower_node=node_registry.register(Node(id = 'test',
 type = 'PRODUCT',
 original_bank_value = 4536,
 original_market_value = 45336,
 original_categorisation_value = 45366,
 residual_bank_value = 4536,
 residual_market_value = 45336,
-residual_categorisation_value = 5600 ),
+residual_categorisation_value = 5600 )),
                  quadrant_number = 2,
                  link_type = 2,
                  number_of_intersections = 1,
                  process_order = 1,
                  priority_table_order = 1),
-Intersection(upper_node=Node(id = 'root',
+Intersection(upper_node=node_registry.register(Node(id = 'root',
 type = 'PRODUCT',
 original_bank_value = 544564,
 original_market_value = 30000,
 original_categorisation_value = 45000,
 residual_bank_value = 15000,
 residual_market_value = 30000,
-residual_categorisation_value = 4500 ),
-             lower_node=Node(id = '1-2KDVAPB',
+residual_categorisation_value = 4500 )),
+             lower_node=node_registry.register(Node(id = '1-2KDVAPB',
 type = 'CHARGE',
 original_bank_value = 15000,
 original_market_value = 30000,
 original_categorisation_value = 45000,
 residual_bank_value = 15000,
 residual_market_value = 30000,
-residual_categorisation_value = 4500 ),
+residual_categorisation_value = 4500 )),
              quadrant_number = 1,
              link_type = 1,
              number_of_intersections = 1,
@@ -131,102 +540,337 @@ residual_categorisation_value = 4500 ),
              priority_table_order = 1)
 ]
 
-def print_tree(intersection_list: list[Intersection]):
-    # First, build a dictionary of parent-child relationships
-    tree_dict = {}
-    root_node = None
+def node_to_dict(node: Node) -> dict:
+    return {
+        'id': node.id,
+        'type': node.type,
+        'original_bank_value': node.original_bank_value,
+        'original_market_value': node.original_market_value,
+        'original_categorisation_value': node.original_categorisation_value,
+        'residual_bank_value': node.residual_bank_value,
+        'residual_market_value': node.residual_market_value,
+        'residual_categorisation_value': node.residual_categorisation_value
+    }
+
+def link_type_name(link_type) -> str:
+    return 'Direct' if link_type == 1 else 'Indirect'
+
+def link_to_dict(intersection: Intersection) -> dict:
+    return {
+        'upper_node': intersection.upper_node.id,
+        'lower_node': intersection.lower_node.id,
+        'link_type': link_type_name(intersection.link_type)
+    }
+
+class IntersectionIndex:
+    """
+    Parent -> children index over an intersection list, built in a single scan. An
+    IntersectionTable is indexed from its columns, and the accessors below read link data
+    straight from them, so walking a table creates no per-link objects.
+    Args:
+        intersection_list: List of Intersection objects, or an IntersectionTable
+    """
+    def __init__(self, intersection_list: list[Intersection]):
+        self.intersections = intersection_list
+        self.table = intersection_list if isinstance(intersection_list, IntersectionTable) else None
+        self.nodes = {}  # node id -> first Node seen with that id
+        self.children = {}  # upper node id -> positions of its intersections
+        self.parents = {}  # lower node id -> upper node id of its first intersection
+        
+        if self.table is not None:
+            ids = [node.id for node in self.table.nodes]
+            self.nodes = dict(zip(ids, self.table.nodes))
+            links = zip(self.table.upper, self.table.lower)
+        else:
+            links = ((intersection.upper_node, intersection.lower_node) for intersection in intersection_list)
+        
+        for position, (upper, lower) in enumerate(links):
+            if self.table is not None:
+                upper_id = ids[upper]
+                lower_id = ids[lower]
+            else:
+                upper_id = upper.id
+                lower_id = lower.id
+                if upper_id not in self.nodes:
+                    self.nodes[upper_id] = upper
+                if lower_id not in self.nodes:
+                    self.nodes[lower_id] = lower
+            try:
+                self.children[upper_id].append(position)
+            except KeyError:
+                self.children[upper_id] = [position]
+            if lower_id not in self.parents:
+                self.parents[lower_id] = upper_id
+        
+        # Roots only ever appear as upper_node, in order of first appearance
+        self.root_ids = [node_id for node_id in self.children if node_id not in self.parents]
     
-    # Find the root node (node that only appears as upper_node but never as lower_node)
-    all_upper = {i.upper_node.id for i in intersection_list}
-    all_lower = {i.lower_node.id for i in intersection_list}
-    root_id = list(all_upper - all_lower)[0]
+    def upper_node(self, position: int) -> Node:
+        if self.table is None:
+            return self.intersections[position].upper_node
+        return self.table.nodes[self.table.upper[position]]
     
-    # Build the tree structure
-    for intersection in intersection_list:
-        parent_id = intersection.upper_node.id
-        if parent_id not in tree_dict:
-            tree_dict[parent_id] = []
-        tree_dict[parent_id].append({
-            'node': intersection.lower_node,
-            'quadrant': intersection.quadrant_number,
-            'link_type': 'Direct' if intersection.link_type == 1 else 'Indirect'
-        })
-    
-    def print_node(node_id, level=0, prefix=""):
-        # Find the node object
-        node = None
-        for intersection in intersection_list:
-            if intersection.upper_node.id == node_id:
-                node = intersection.upper_node
-            elif intersection.lower_node.id == node_id:
-                node = intersection.lower_node
-            if node:
-                break
+    def lower_node(self, position: int) -> Node:
+        if self.table is None:
+            return self.intersections[position].lower_node
+        return self.table.nodes[self.table.lower[position]]
+    
+    def quadrant_of(self, position: int) -> int:
+        if self.table is None:
+            return self.intersections[position].quadrant_number
+        return self.table.quadrant_number[position]
+    
+    def link_type_of(self, position: int) -> int:
+        if self.table is None:
+            return self.intersections[position].link_type
+        return self.table.link_type[position]
+    
+    def walk_positions(self):
+        """
+        Depth-first walk from the roots yielding (node, depth, position, first_visit), position
+        being None for a root. Every intersection is yielded exactly once. A node reached a second
+        time is yielded with first_visit=False and is not expanded again, so shared nodes and
+        cycles are safe. Upper nodes that are not reachable from a root (e.g. a cycle) are walked
+        after the roots.
+        """
+        expanded = set()
+        root_ids = set(self.root_ids)
+        starts = self.root_ids + [node_id for node_id in self.children if node_id not in root_ids]
         
-        # Print node information
-        indent = "    " * level
-        print(f"{indent}{prefix}Node ID: {node.id}")
-        print(f"{indent}├── Type: {node.type}")
-        print(f"{indent}├── Original Bank Value: {node.original_bank_value}")
-        print(f"{indent}├── Original Market Value: {node.original_market_value}")
-        print(f"{indent}├── Original Cat Value: {node.original_categorisation_value}")
-        print(f"{indent}├── Residual Bank Value: {node.residual_bank_value}")
-        print(f"{indent}├── Residual Market Value: {node.residual_market_value}")
-        print(f"{indent}└── Residual Cat Value: {node.residual_categorisation_value}")
-        
-        # Print children
-        if node_id in tree_dict:
-            for idx, child in enumerate(tree_dict[node_id]):
-                print(f"{indent}    |")
-                print(f"{indent}    ├── Q{child['quadrant']} ({child['link_type']})")
-                print(f"{indent}    |")
-                print_node(child['node'].id, level + 1)
-    
-    # Start printing from root
-    print_node(root_id)
+        for start_id in starts:
+            if start_id in expanded:
+                continue
+            expanded.add(start_id)
+            yield self.nodes[start_id], 0, None, True
+            
+            stack = [(0, iter(self.children.get(start_id, ())))]
+            while stack:
+                depth, positions = stack[-1]
+                position = next(positions, None)
+                if position is None:
+                    stack.pop()
+                    continue
+                child = self.lower_node(position)
+                first_visit = child.id not in expanded
+                yield child, depth + 1, position, first_visit
+                if first_visit:
+                    expanded.add(child.id)
+                    stack.append((depth + 1, iter(self.children.get(child.id, ()))))
+    
+    def walk(self):
+        """walk_positions with the intersection of each position: (node, depth, intersection, position, first_visit)."""
+        for node, depth, position, first_visit in self.walk_positions():
+            yield node, depth, None if position is None else self.intersections[position], position, first_visit
 
-print_tree(intersection_list)
+class ExportSink:
+    """
+    Base class for export formats fed by export_intersections. visit gets Intersection objects;
+    visit_row is called instead for an IntersectionTable, with the row number to read from its
+    columns (the default wraps the row in an IntersectionRow and calls visit).
+    """
+    def visit(self, node: Node, depth: int, intersection, position, first_visit: bool):
+        pass
+    
+    def visit_row(self, table, node: Node, depth: int, row, first_visit: bool):
+        self.visit(node, depth, None if row is None else table[row], row, first_visit)
+    
+    def finish(self):
+        return None
 
-def output_json(intersection_list: list[Intersection]) -> dict:
-    # Initialize result dictionary
-    result = {}
+class TextTreeSink(ExportSink):
+    def __init__(self, stream=None):
+        self.stream = stream  # None prints to stdout
     
-    for intersection in intersection_list:
-        quadrant = intersection.quadrant_number
+    def visit(self, node, depth, intersection, position, first_visit):
+        if intersection is None:
+            self._write(node, depth, None, None, first_visit)
+        else:
+            self._write(node, depth, intersection.quadrant_number, intersection.link_type, first_visit)
+    
+    def visit_row(self, table, node, depth, row, first_visit):
+        if row is None:
+            self._write(node, depth, None, None, first_visit)
+        else:
+            self._write(node, depth, table.quadrant_number[row], table.link_type[row], first_visit)
+    
+    def _write(self, node, depth, quadrant, link_type, first_visit):
+        if quadrant is not None:
+            # Connector from the parent, at the parent's indentation
+            parent_indent = "    " * (depth - 1)
+            print(f"{parent_indent}    |", file=self.stream)
+            print(f"{parent_indent}    ├── Q{quadrant} ({link_type_name(link_type)})", file=self.stream)
+            print(f"{parent_indent}    |", file=self.stream)
         
-        # Initialize quadrant if not exists
-        if quadrant not in result:
-            result[quadrant] = {
-                'nodes': [],
-                'prioritised_links': []
-            }
+        indent = "    " * depth
+        if not first_visit:
+            print(f"{indent}Node ID: {node.id} (shown above)", file=self.stream)
+            return
+        print(f"{indent}Node ID: {node.id}", file=self.stream)
+        print(f"{indent}├── Type: {node.type}", file=self.stream)
+        print(f"{indent}├── Original Bank Value: {node.original_bank_value}", file=self.stream)
+        print(f"{indent}├── Original Market Value: {node.original_market_value}", file=self.stream)
+        print(f"{indent}├── Original Cat Value: {node.original_categorisation_value}", file=self.stream)
+        print(f"{indent}├── Residual Bank Value: {node.residual_bank_value}", file=self.stream)
+        print(f"{indent}├── Residual Market Value: {node.residual_market_value}", file=self.stream)
+        print(f"{indent}└── Residual Cat Value: {node.residual_categorisation_value}", file=self.stream)
+
+class JsonSink(ExportSink):
+    """Builds the same nested dict as output_json, in the same order."""
+    def __init__(self):
+        self.quadrants = {}  # quadrant -> [first position, {id: (order, node)}, [positions]]
+        self.intersections = {}  # position -> Intersection, when fed through visit
+        self.table = None  # when fed through visit_row
+    
+    def visit(self, node, depth, intersection, position, first_visit):
+        if intersection is None:
+            return
+        self.intersections[position] = intersection
+        self._add(position, intersection.quadrant_number, intersection.upper_node, intersection.lower_node)
+    
+    def visit_row(self, table, node, depth, row, first_visit):
+        if row is None:
+            return
+        self.table = table
+        self._add(row, table.quadrant_number[row], table.nodes[table.upper[row]], table.nodes[table.lower[row]])
+    
+    def _add(self, position, quadrant, upper_node, lower_node):
+        try:
+            entry = self.quadrants[quadrant]
+        except KeyError:
+            entry = self.quadrants[quadrant] = [position, {}, []]
+        entry[0] = min(entry[0], position)
         
-        # Add upper and lower nodes if they don't exist
-        for node in [intersection.upper_node, intersection.lower_node]:
-            node_dict = {
-                'id': node.id,
-                'type': node.type,
-                'original_bank_value': node.original_bank_value,
-                'original_market_value': node.original_market_value,
-                'original_categorisation_value': node.original_categorisation_value,
-                'residual_bank_value': node.residual_bank_value,
-                'residual_market_value': node.residual_market_value,
-                'residual_categorisation_value': node.residual_categorisation_value
-            }
-            
-            # Check if node already exists in the list
-            if not any(n['id'] == node.id for n in result[quadrant]['nodes']):
-                result[quadrant]['nodes'].append(node_dict)
-        
-        # Add intersection to prioritised_links
-        link = {
-            'upper_node': intersection.upper_node.id,
-            'lower_node': intersection.lower_node.id,
-            'link_type': 'Direct' if intersection.link_type == 1 else 'Indirect'
+        # Keep the first occurrence of each node in input order (upper before lower)
+        nodes = entry[1]
+        for order, link_node in ((2 * position, upper_node), (2 * position + 1, lower_node)):
+            existing = nodes.get(link_node.id)
+            if existing is None or order < existing[0]:
+                nodes[link_node.id] = (order, link_node)
+        entry[2].append(position)
+    
+    def _link_dict(self, position) -> dict:
+        if self.table is None:
+            return link_to_dict(self.intersections[position])
+        table = self.table
+        return {
+            'upper_node': table.nodes[table.upper[position]].id,
+            'lower_node': table.nodes[table.lower[position]].id,
+            'link_type': link_type_name(table.link_type[position])
         }
-        result[quadrant]['prioritised_links'].append(link)
     
-    return result
+    def finish(self) -> dict:
+        result = {}
+        for quadrant, (_, nodes, positions) in sorted(self.quadrants.items(), key=lambda item: item[1][0]):
+            result[quadrant] = {
+                'nodes': [node_to_dict(n) for _, n in sorted(nodes.values(), key=lambda item: item[0])],
+                'prioritised_links': [self._link_dict(position) for position in sorted(positions)]
+            }
+        return result
+
+class NdjsonSink(ExportSink):
+    """Streams one JSON object per line: each node once per quadrant, then each link."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = set()  # (quadrant, node id)
+        self.lines = 0
+    
+    def visit(self, node, depth, intersection, position, first_visit):
+        if intersection is not None:
+            self._write(position, intersection.quadrant_number, intersection.upper_node, intersection.lower_node, intersection.link_type)
+    
+    def visit_row(self, table, node, depth, row, first_visit):
+        if row is not None:
+            self._write(row, table.quadrant_number[row], table.nodes[table.upper[row]], table.nodes[table.lower[row]], table.link_type[row])
+    
+    def _write(self, position, quadrant, upper_node, lower_node, link_type):
+        for link_node in (upper_node, lower_node):
+            if (quadrant, link_node.id) not in self.written:
+                self.written.add((quadrant, link_node.id))
+                self.stream.write(json.dumps({'record': 'node', 'quadrant': quadrant, **node_to_dict(link_node)}) + "\n")
+                self.lines += 1
+        self.stream.write(json.dumps({
+            'record': 'link',
+            'quadrant': quadrant,
+            'position': position,
+            'upper_node': upper_node.id,
+            'lower_node': lower_node.id,
+            'link_type': link_type_name(link_type)
+        }) + "\n")
+        self.lines += 1
+    
+    def finish(self) -> int:
+        return self.lines
+
+class DotSink(ExportSink):
+    """Builds a graphviz Digraph; render it with dot.render(...) or read dot.source."""
+    def __init__(self, comment='Tree Visualization'):
+        self.dot = Digraph(comment=comment)
+        self.dot.attr(rankdir='TB')
+        self.nodes_set = set()
+    
+    def _add_node(self, node: Node):
+        if node.id in self.nodes_set:
+            return
+        self.nodes_set.add(node.id)
+        self.dot.node(node.id, (
+            f"{node.id}\\n"
+            f"Original Bank Value: {node.original_bank_value}\\n"
+            f"Original Market Value: {node.original_market_value}\\n"
+            f"Original Categorisation Value: {node.original_categorisation_value}\\n"
+            f"Residual Bank Value: {node.residual_bank_value}\\n"
+            f"Residual Market Value: {node.residual_market_value}\\n"
+            f"Residual Categorisation Value: {node.residual_categorisation_value}"
+        ))
+    
+    def visit(self, node, depth, intersection, position, first_visit):
+        if intersection is None:
+            self._add_node(node)
+        else:
+            self._add_edge(position, intersection.upper_node, intersection.lower_node, intersection.link_type)
+    
+    def visit_row(self, table, node, depth, row, first_visit):
+        if row is None:
+            self._add_node(node)
+        else:
+            self._add_edge(row, table.nodes[table.upper[row]], table.nodes[table.lower[row]], table.link_type[row])
+    
+    def _add_edge(self, position, upper_node, lower_node, link_type):
+        self._add_node(upper_node)
+        self._add_node(lower_node)
+        link_style = 'solid' if link_type == 1 else 'dashed'
+        link_label = f"{'D' if link_type == 1 else 'I'} (Index: {position})"
+        self.dot.edge(upper_node.id, lower_node.id, label=link_label, style=link_style)
+    
+    def finish(self):
+        return self.dot
+
+def export_intersections(intersection_list: list[Intersection], sinks: list[ExportSink]) -> list:
+    """
+    Indexes the intersections once and feeds every sink from a single walk.
+    Args:
+        intersection_list: List of Intersection objects, or an IntersectionTable (sinks then get visit_row)
+        sinks: Export sinks (TextTreeSink, JsonSink, NdjsonSink, DotSink, ...)
+    Returns:
+        The result of each sink's finish(), in the order the sinks were given
+    """
+    index = IntersectionIndex(intersection_list)
+    if index.table is not None:
+        for node, depth, row, first_visit in index.walk_positions():
+            for sink in sinks:
+                sink.visit_row(index.table, node, depth, row, first_visit)
+    else:
+        for node, depth, intersection, position, first_visit in index.walk():
+            for sink in sinks:
+                sink.visit(node, depth, intersection, position, first_visit)
+    return [sink.finish() for sink in sinks]
+
+def print_tree(intersection_list: list[Intersection]):
+    export_intersections(intersection_list, [TextTreeSink()])
+
+print_tree(intersection_list)
+
+def output_json(intersection_list: list[Intersection]) -> dict:
+    return export_intersections(intersection_list, [JsonSink()])[0]
 
 json_output = output_json(intersection_list)
 # Pretty print the result
@@ -376,6 +1020,1263 @@ def compare_json_outputs(dict1: dict, dict2: dict) -> dict:
     
     return differences
 
+def write_text_column(out, values):
+    """Writes strings as int32 byte lengths followed by the utf-8 bytes (little-endian)."""
+    text = ''.join(values)
+    if text.isascii():
+        # Byte lengths equal character lengths, so encode the whole column at once
+        lengths = array('i', map(len, values))
+        data = text.encode('ascii')
+    else:
+        encoded = [value.encode('utf-8') for value in values]
+        lengths = array('i', map(len, encoded))
+        data = b''.join(encoded)
+    write_int_column(out, lengths, 'i')
+    out.write(data)
+
+def read_text_column(f, count: int) -> list:
+    lengths = read_int_column(f, count, 'i')
+    data = f.read(sum(lengths))
+    if data.isascii():
+        data = data.decode('ascii')
+        decode = False
+    else:
+        decode = True
+    values = []
+    offset = 0
+    for length in lengths:
+        value = data[offset:offset + length]
+        values.append(value.decode('utf-8') if decode else value)
+        offset += length
+    return values
+
+def write_int_column(out, values, typecode: str = 'q'):
+    """Writes an int column as fixed-width little-endian values."""
+    if not isinstance(values, array) or values.typecode != typecode or sys.byteorder == 'big':
+        values = array(typecode, values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+    values.tofile(out)
+
+def read_int_column(f, count: int, typecode: str = 'q') -> array:
+    values = array(typecode)
+    values.fromfile(f, count)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+PRODUCT_RESULT_TEXT_COLUMNS = ('product_id', 'lcc')
+PRODUCT_RESULT_INT_COLUMNS = ('lbvr1', 'lbvr2', 'lmvr1', 'lmvr2', 'final_lbvr', 'final_lmvr')
+PRODUCT_RESULT_COLUMNS = PRODUCT_RESULT_TEXT_COLUMNS + PRODUCT_RESULT_INT_COLUMNS
+PRODUCT_RESULT_BLOCK_MAGIC = b'LCCR'
+CSV_SPECIAL_CHARACTERS = (',', '"', '\r', '\n')
+
+class ProductResultWriter:
+    """
+    Writes ProductResult rows in chunks to CSV and/or a binary columnar file.
+    Rows are buffered per column (lists for text, array('q') for ints) and written once
+    chunk_size rows are buffered. Both files are opened for appending, so several batches
+    (or runs) extend the same output; the CSV header is only written to a new file.
+    Binary layout is a sequence of blocks, one per chunk (little-endian):
+        magic 'LCCR', int64 row count,
+        per text column: int32 byte length of each value, then the utf-8 bytes (write_text_column),
+        per int column: int64 values
+    Args:
+        csv_path: CSV output file, or None
+        binary_path: Columnar output file, or None
+        chunk_size: Rows buffered before a chunk is written
+        buffer_size: Write buffer size of the underlying files
+    """
+    def __init__(self, csv_path=None, binary_path=None, chunk_size=100_000, buffer_size=1 << 20):
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._getters = [attrgetter(name) for name in PRODUCT_RESULT_COLUMNS]
+        self._reset()
+        
+        self.csv_file = None
+        if csv_path is not None:
+            write_header = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+            self.csv_file = open(csv_path, 'a', newline='', buffering=buffer_size)
+            self.csv_writer = csv.writer(self.csv_file)
+            if write_header:
+                self.csv_writer.writerow(PRODUCT_RESULT_COLUMNS)
+        
+        self.binary_file = None
+        if binary_path is not None:
+            self.binary_file = open(binary_path, 'ab', buffering=buffer_size)
+    
+    def _reset(self):
+        # One buffer per column, in PRODUCT_RESULT_COLUMNS order
+        self.columns = [[] for _ in PRODUCT_RESULT_TEXT_COLUMNS] + [array('q') for _ in PRODUCT_RESULT_INT_COLUMNS]
+        self.rows = 0
+    
+    def add(self, result: ProductResult):
+        for values, getter in zip(self.columns, self._getters):
+            values.append(getter(result))
+        self.rows += 1
+        if self.rows >= self.chunk_size:
+            self.flush()
+    
+    def extend(self, results):
+        results = iter(results)
+        while True:
+            chunk = list(islice(results, self.chunk_size - self.rows))
+            if not chunk:
+                break
+            for values, getter in zip(self.columns, self._getters):
+                values.extend(map(getter, chunk))
+            self.rows += len(chunk)
+            if self.rows >= self.chunk_size:
+                self.flush()
+    
+    def add_columns(self, columns: dict):
+        """Adds rows given as columns, e.g. {'product_id': [...], 'lcc': [...], 'lbvr1': array('q'), ...}."""
+        lengths = {len(columns[name]) for name in PRODUCT_RESULT_COLUMNS}
+        if len(lengths) != 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+        for values, name in zip(self.columns, PRODUCT_RESULT_COLUMNS):
+            values.extend(columns[name])
+        self.rows += lengths.pop()
+        if self.rows >= self.chunk_size:
+            self.flush()
+    
+    def flush(self):
+        if not self.rows:
+            return
+        if self.csv_file is not None:
+            self._write_csv(self.columns)
+        if self.binary_file is not None:
+            self._write_block(self.columns)
+        self.rows_written += self.rows
+        self._reset()
+    
+    def _write_csv(self, columns: list):
+        text_columns = columns[:len(PRODUCT_RESULT_TEXT_COLUMNS)]
+        if any(c in value for values in text_columns for value in set(values) for c in CSV_SPECIAL_CHARACTERS):
+            # Some values need quoting, let the csv module handle it
+            self.csv_writer.writerows(zip(*columns))
+            return
+        str_columns = text_columns + [map(str, values) for values in columns[len(PRODUCT_RESULT_TEXT_COLUMNS):]]
+        self.csv_file.write('\r\n'.join(map(','.join, zip(*str_columns))) + '\r\n')
+    
+    def _write_block(self, columns: list):
+        out = self.binary_file
+        out.write(PRODUCT_RESULT_BLOCK_MAGIC + struct.pack('<q', self.rows))
+        for values in columns[:len(PRODUCT_RESULT_TEXT_COLUMNS)]:
+            write_text_column(out, values)
+        for values in columns[len(PRODUCT_RESULT_TEXT_COLUMNS):]:
+            write_int_column(out, values)
+    
+    def close(self):
+        self.flush()
+        if self.csv_file is not None:
+            self.csv_file.close()
+        if self.binary_file is not None:
+            self.binary_file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def read_product_result_columns(binary_path):
+    """
+    Reads a file written by ProductResultWriter, yielding one dict of columns per block
+    (lists for the text columns, array('q') for the int columns).
+    """
+    with open(binary_path, 'rb') as f:
+        while True:
+            header = f.read(12)
+            if not header:
+                return
+            magic, rows = header[:4], struct.unpack('<q', header[4:])[0]
+            if magic != PRODUCT_RESULT_BLOCK_MAGIC:
+                raise ValueError(f"Not a product result block at offset {f.tell() - 12}")
+            
+            columns = {}
+            for name in PRODUCT_RESULT_TEXT_COLUMNS:
+                columns[name] = read_text_column(f, rows)
+            for name in PRODUCT_RESULT_INT_COLUMNS:
+                columns[name] = read_int_column(f, rows)
+            yield columns
+
+LINK_TYPE_VALUES = frozenset(link_type.value for link_type in LinkType)
+
+@dataclass
+class ValidationProblem:
+    code: str  # no_root, multiple_roots, cycle, dangling_node, conflicting_node, unknown_link_type
+    message: str
+    node_id: str = None
+    position: int = None  # index in the intersection list, when the problem belongs to one intersection
+
+@dataclass
+class ValidationReport:
+    problems: list
+    root_ids: list
+    
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+    
+    def raise_if_invalid(self):
+        if self.problems:
+            raise IntersectionValidationError(self)
+
+class IntersectionValidationError(ValueError):
+    def __init__(self, report: ValidationReport):
+        self.report = report
+        super().__init__("Invalid intersection list:\n" + "\n".join(f"  [{p.code}] {p.message}" for p in report.problems))
+
+def _known_link_type(link_type) -> bool:
+    try:
+        return link_type in LINK_TYPE_VALUES or getattr(link_type, 'value', None) in LINK_TYPE_VALUES
+    except TypeError:  # unhashable, e.g. a list
+        return False
+
+def validate_intersections(intersection_list: list[Intersection], allow_forest: bool = False) -> ValidationReport:
+    """
+    Checks an intersection list in one pass over the links plus a linear cycle search,
+    collecting every problem instead of stopping at the first one.
+    Args:
+        intersection_list: List of Intersection objects
+        allow_forest: Accept more than one root
+    Returns:
+        ValidationReport with all problems found and the root ids
+    """
+    problems = []
+    nodes = {}  # node id -> (first Node seen, its values, position)
+    children = {}  # upper node id -> lower node ids
+    lower_ids = set()
+    node_values = attrgetter(*NODE_FIELDS)
+    
+    for position, intersection in enumerate(intersection_list):
+        if not _known_link_type(intersection.link_type):
+            problems.append(ValidationProblem('unknown_link_type', f"Intersection {position} has unknown link type {intersection.link_type!r}", position=position))
+        
+        linked = True
+        for role in ('upper_node', 'lower_node'):
+            node = getattr(intersection, role)
+            if node is None or not getattr(node, 'id', None):
+                problems.append(ValidationProblem('dangling_node', f"Intersection {position} has no {role} id", position=position))
+                linked = False
+                continue
+            
+            first = nodes.get(node.id)
+            if first is None:
+                nodes[node.id] = (node, node_values(node), position)
+            elif first[0] is not node:
+                values = node_values(node)
+                if values != first[1]:
+                    differing = [name for name, a, b in zip(NODE_FIELDS, first[1], values) if a != b]
+                    problems.append(ValidationProblem(
+                        'conflicting_node',
+                        f"Node {node.id} in intersection {position} differs from intersection {first[2]} in {', '.join(differing)}",
+                        node_id=node.id, position=position))
+        if not linked:
+            continue
+        
+        try:
+            children[intersection.upper_node.id].append(intersection.lower_node.id)
+        except KeyError:
+            children[intersection.upper_node.id] = [intersection.lower_node.id]
+        lower_ids.add(intersection.lower_node.id)
+    
+    root_ids = [node_id for node_id in children if node_id not in lower_ids]
+    if children and not root_ids:
+        problems.append(ValidationProblem('no_root', "No root node: every node appears as a lower node"))
+    elif len(root_ids) > 1 and not allow_forest:
+        problems.append(ValidationProblem('multiple_roots', f"Expected a single root, found {len(root_ids)}: {', '.join(root_ids)}"))
+    
+    # Iterative three-colour DFS, each node and link is visited once. A cycle is reported as
+    # its back edge, so the cost per cycle does not grow with its length.
+    on_stack = {}  # node id -> depth, while on the stack
+    finished = set()
+    for start_id in children:
+        if start_id in finished:
+            continue
+        on_stack[start_id] = 0
+        path = [start_id]
+        stack = [iter(children[start_id])]
+        while stack:
+            child_id = next(stack[-1], None)
+            if child_id is None:
+                stack.pop()
+                node_id = path.pop()
+                del on_stack[node_id]
+                finished.add(node_id)
+                continue
+            depth = on_stack.get(child_id)
+            if depth is not None:
+                length = len(path) - depth
+                problems.append(ValidationProblem('cycle', f"Cycle of {length} link(s) closed by {path[-1]} -> {child_id}", node_id=child_id))
+            elif child_id not in finished:
+                on_stack[child_id] = len(path)
+                path.append(child_id)
+                stack.append(iter(children.get(child_id, ())))
+    
+    return ValidationReport(problems=problems, root_ids=root_ids)
+
+class LazyTreeView:
+    """
+    Text tree that formats a node only when its line is produced. Nodes below max_depth collapse
+    to one summary line (child count and summed residuals below them), and at most max_children
+    children are listed under a node, the rest summarised on one line. expand() opens a collapsed
+    node, focus() expands only the branch from the root to one node.
+    Args:
+        intersection_list: List of Intersection objects, or an IntersectionTable
+        max_depth: Levels expanded below the root
+        max_children: Children listed per node before the rest are summarised
+    """
+    def __init__(self, intersection_list: list[Intersection], max_depth: int = 3, max_children: int = 20):
+        self.index = IntersectionIndex(intersection_list)
+        self.max_depth = max_depth
+        self.max_children = max_children
+        self.expanded = set()
+        self.focus_path = None
+        self._totals = {}  # node id -> (nodes below, residual bank, market, cat below)
+    
+    def expand(self, node_id: str):
+        self.expanded.add(node_id)
+    
+    def collapse(self, node_id: str):
+        self.expanded.discard(node_id)
+    
+    def focus(self, node_id: str) -> list:
+        """Shows only the branch from the root down to node_id (and node_id's own subtree)."""
+        if node_id not in self.index.nodes:
+            raise KeyError(f"Node with id {node_id} not found")
+        path = [node_id]
+        on_path = {node_id}
+        parents = self.index.parents
+        while path[-1] in parents and parents[path[-1]] not in on_path:
+            path.append(parents[path[-1]])
+            on_path.add(path[-1])
+        self.focus_path = path[::-1]
+        return self.focus_path
+    
+    def clear_focus(self):
+        self.focus_path = None
+    
+    def refresh(self):
+        """Forget cached subtree totals, e.g. after residual values changed."""
+        self._totals.clear()
+    
+    def render(self, stream=None, limit: int = None):
+        for line in islice(self.lines(), limit):
+            print(line, file=stream)
+    
+    def lines(self):
+        index = self.index
+        on_path = set(self.focus_path or ())
+        target = self.focus_path[-1] if self.focus_path else None
+        if self.focus_path:
+            roots = self.focus_path[:1]
+        else:
+            roots = index.root_ids or list(index.children)[:1]
+        shown = set()
+        
+        for root_id in roots:
+            line, frame = self._visit(index.nodes[root_id], None, "", True, self.max_depth, shown, on_path, target)
+            yield line
+            stack = [[frame, 0]] if frame else []
+            while stack:
+                entry = stack[-1]
+                child_prefix, visible, hidden, child_budget = entry[0]
+                i = entry[1]
+                if i == len(visible):
+                    stack.pop()
+                    if hidden:
+                        yield self._hidden_summary(child_prefix, hidden)
+                    continue
+                entry[1] += 1
+                position = visible[i]
+                last = i == len(visible) - 1 and not hidden
+                line, frame = self._visit(index.lower_node(position), position, child_prefix, last, child_budget, shown, on_path, target)
+                yield line
+                if frame:
+                    stack.append([frame, 0])
+    
+    def _visit(self, node: Node, position, prefix: str, last: bool, budget: int, shown: set, on_path: set, target):
+        # Returns the node's line and, if it is expanded, the frame used to list its children
+        connector = "└── " if last else "├── "
+        link = "" if position is None else f"Q{self.index.quadrant_of(position)} ({link_type_name(self.index.link_type_of(position))}) "
+        positions = self.index.children.get(node.id, ())
+        line = (
+            f"{prefix}{connector}{link}{node.id} [{node.type}] residual bank/market/cat "
+            f"{node.residual_bank_value}/{node.residual_market_value}/{node.residual_categorisation_value}"
+        )
+        if not positions:
+            return line, None
+        if node.id in shown:
+            return f"{prefix}{connector}{link}{node.id} (shown above)", None
+        if budget <= 0 and node.id not in self.expanded and node.id not in on_path:
+            count, bank, market, cat = self._subtree_totals(node.id)
+            return f"{line} [+{len(positions)} children, {count} nodes below, residual below {bank}/{market}/{cat}]", None
+        
+        shown.add(node.id)
+        if node.id == target:
+            child_budget = self.max_depth - 1
+        elif node.id in on_path:
+            child_budget = 0  # siblings of the focused branch stay collapsed
+        else:
+            child_budget = budget - 1
+        
+        visible = list(positions)
+        hidden = []
+        if len(visible) > self.max_children and node.id not in self.expanded:
+            visible, hidden = visible[:self.max_children], visible[self.max_children:]
+            for i, position in enumerate(hidden):
+                if self.index.lower_node(position).id in on_path:
+                    visible.append(hidden.pop(i))
+                    break
+        return line, (prefix + ("    " if last else "│   "), visible, hidden, child_budget)
+    
+    def _hidden_summary(self, prefix: str, hidden: list) -> str:
+        count = bank = market = cat = 0
+        for position in hidden:
+            child = self.index.lower_node(position)
+            below = self._subtree_totals(child.id)
+            count += 1 + below[0]
+            bank += child.residual_bank_value + below[1]
+            market += child.residual_market_value + below[2]
+            cat += child.residual_categorisation_value + below[3]
+        return f"{prefix}└── ... {len(hidden)} more children, {count} nodes, residual {bank}/{market}/{cat}"
+    
+    def _subtree_totals(self, node_id: str) -> tuple:
+        # Iterative post-order, memoised; a link back into the current path (a cycle) counts as empty
+        totals = self._totals
+        children = self.index.children
+        lower_node = self.index.lower_node
+        if node_id in totals:
+            return totals[node_id]
+        
+        in_progress = set()
+        stack = [(node_id, False)]
+        while stack:
+            current, done = stack.pop()
+            if done:
+                count = bank = market = cat = 0
+                for position in children.get(current, ()):
+                    child = lower_node(position)
+                    below = totals.get(child.id, (0, 0, 0, 0))
+                    count += 1 + below[0]
+                    bank += child.residual_bank_value + below[1]
+                    market += child.residual_market_value + below[2]
+                    cat += child.residual_categorisation_value + below[3]
+                totals[current] = (count, bank, market, cat)
+                in_progress.discard(current)
+                continue
+            if current in totals or current in in_progress:
+                continue
+            in_progress.add(current)
+            stack.append((current, True))
+            for position in children.get(current, ()):
+                child_id = lower_node(position).id
+                if child_id not in totals and child_id not in in_progress:
+                    stack.append((child_id, False))
+        return totals[node_id]
+
+def intersection_to_record(intersection: Intersection) -> dict:
+    return {
+        'upper_node': node_to_dict(intersection.upper_node),
+        'lower_node': node_to_dict(intersection.lower_node),
+        'quadrant_number': intersection.quadrant_number,
+        'link_type': intersection.link_type,
+        'number_of_intersections': intersection.number_of_intersections,
+        'process_order': intersection.process_order,
+        'priority_table_order': intersection.priority_table_order
+    }
+
+def intersection_from_record(record: dict, registry: NodeRegistry = None) -> Intersection:
+    upper_node = Node(**record['upper_node'])
+    lower_node = Node(**record['lower_node'])
+    if registry is not None:
+        upper_node = registry.register(upper_node)
+        lower_node = registry.register(lower_node)
+    return Intersection(
+        upper_node=upper_node,
+        lower_node=lower_node,
+        quadrant_number=record['quadrant_number'],
+        link_type=record['link_type'],
+        number_of_intersections=record['number_of_intersections'],
+        process_order=record['process_order'],
+        priority_table_order=record['priority_table_order']
+    )
+
+def write_json_atomic(path: str, data):
+    # Write to a temporary file next to the target and rename it, so readers never see a partial file
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class ShardedBatchRunner:
+    """
+    Runs process_shard(shard, intersection_lists) over a batch split into shards by a hash of
+    each list's root id. Progress is kept in work_dir, so a crashed run resumes with the shards
+    that are not done, and any number of worker processes (also on other machines sharing the
+    directory) can call run() at the same time; a shard is claimed through its lock file.
+    Layout of work_dir:
+        partition.json          written once every shard input file exists
+        shard-00003.ndjson      input, one intersection list per line
+        shard-00003.lock        held by the worker processing the shard
+        shard-00003.done.json   checkpoint manifest, written atomically when the shard is done
+    A lock names its worker (host and pid) and is touched every heartbeat_seconds while it is
+    held. It is reclaimed when its worker is a process on this host that is no longer running,
+    or when it has not been touched for stale_lock_seconds (needed for workers on other hosts).
+    Args:
+        work_dir: Directory shared by all workers
+        process_shard: Callable taking the shard number and an iterator of intersection lists,
+            returning a JSON serialisable summary stored in the manifest
+        num_shards: Number of shards the batch is split into
+        stale_lock_seconds: Age after which a lock from another host counts as abandoned, None to
+            only reclaim locks of dead processes on this host. Keep it well above heartbeat_seconds.
+        heartbeat_seconds: How often a held lock is touched
+    """
+    def __init__(self, work_dir: str, process_shard, num_shards: int = 64, stale_lock_seconds: float = None,
+                 heartbeat_seconds: float = 10):
+        self.work_dir = work_dir
+        self.process_shard = process_shard
+        self.num_shards = num_shards
+        self.stale_lock_seconds = stale_lock_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.host = socket.gethostname()
+        self.worker_id = f"{self.host}:{os.getpid()}"
+        os.makedirs(work_dir, exist_ok=True)
+    
+    def _path(self, name: str) -> str:
+        return os.path.join(self.work_dir, name)
+    
+    def shard_of(self, intersection_list: list[Intersection]) -> int:
+        index = IntersectionIndex(intersection_list)
+        if index.root_ids:
+            root_id = index.root_ids[0]
+        elif intersection_list:
+            root_id = intersection_list[0].upper_node.id
+        else:
+            root_id = ''  # empty list, nothing to route by
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(root_id.encode('utf-8')) % self.num_shards
+    
+    def partition(self, intersection_lists) -> bool:
+        """
+        Writes the shard input files. Returns False without reading the input if the batch
+        was already partitioned or another worker is partitioning it.
+        """
+        if os.path.exists(self._path('partition.json')):
+            return False
+        token = self._claim('partition.lock')
+        if token is None:
+            return False
+        with self._heartbeat('partition.lock', token):
+            counts = [0] * self.num_shards
+            tmp_suffix = f".{self.host}.{os.getpid()}.tmp"
+            tmp_paths = [self._path(f"shard-{shard:05d}.ndjson{tmp_suffix}") for shard in range(self.num_shards)]
+            files = []
+            try:
+                for tmp_path in tmp_paths:
+                    files.append(open(tmp_path, 'w'))
+                for intersection_list in intersection_lists:
+                    shard = self.shard_of(intersection_list)
+                    files[shard].write(json.dumps([intersection_to_record(i) for i in intersection_list]) + "\n")
+                    counts[shard] += 1
+                for f in files:
+                    f.close()
+                for shard, tmp_path in enumerate(tmp_paths):
+                    os.replace(tmp_path, self._path(f"shard-{shard:05d}.ndjson"))
+            finally:
+                # Only left over when partitioning failed
+                for f in files:
+                    f.close()
+                for tmp_path in tmp_paths:
+                    try:
+                        os.remove(tmp_path)
+                    except FileNotFoundError:
+                        pass
+            write_json_atomic(self._path('partition.json'), {'num_shards': self.num_shards, 'lists_per_shard': counts})
+        return True
+    
+    def is_done(self, shard: int) -> bool:
+        return os.path.exists(self._path(f"shard-{shard:05d}.done.json"))
+    
+    def pending_shards(self) -> list[int]:
+        return [shard for shard in range(self.num_shards) if not self.is_done(shard)]
+    
+    def _claim(self, lock_name: str):
+        """Creates the lock, reclaiming it if its owner is gone. Returns the lock's token, or None if it is held."""
+        lock_path = self._path(lock_name)
+        token = uuid.uuid4().hex
+        # Write the content first and hard link it into place, so the lock never exists half written
+        tmp_path = f"{lock_path}.{token}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'worker': self.worker_id, 'token': token, 'claimed_at': time.time()}, f)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp_path, lock_path)
+                    return token
+                except FileExistsError:
+                    if not self._break_abandoned_lock(lock_path):
+                        return None
+            return None
+        finally:
+            os.remove(tmp_path)
+    
+    def _read_lock(self, lock_path: str):
+        try:
+            with open(lock_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {}  # not written by this class, judged by age only
+    
+    def _break_abandoned_lock(self, lock_path: str) -> bool:
+        lock = self._read_lock(lock_path)
+        if lock is None:
+            return True  # released in the meantime
+        if not self._is_abandoned(lock_path, lock):
+            return False
+        self._take_lock(lock_path, lock.get('token'))
+        return True
+    
+    def _is_abandoned(self, lock_path: str, lock: dict) -> bool:
+        host, _, pid = lock.get('worker', '').rpartition(':')
+        if host == self.host and pid.isdigit() and int(pid) != os.getpid():
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass  # running, under another user
+        if self.stale_lock_seconds is None:
+            return False
+        try:
+            return time.time() - os.path.getmtime(lock_path) > self.stale_lock_seconds
+        except FileNotFoundError:
+            return True
+    
+    def _take_lock(self, lock_path: str, token) -> bool:
+        """
+        Atomically removes the lock if it still has the given token. The lock is renamed away
+        first, so two workers can never both remove it; a lock that turns out to have been
+        replaced in the meantime is put back.
+        """
+        taken_path = f"{lock_path}.{uuid.uuid4().hex}.taken"
+        try:
+            os.rename(lock_path, taken_path)
+        except FileNotFoundError:
+            return False
+        if self._read_lock(taken_path).get('token') == token:
+            os.remove(taken_path)
+            return True
+        try:
+            os.link(taken_path, lock_path)
+        except FileExistsError:
+            pass  # already claimed again; the displaced owner notices when it releases
+        os.remove(taken_path)
+        return False
+    
+    @contextmanager
+    def _heartbeat(self, lock_name: str, token: str):
+        """Keeps the lock fresh while the block runs, then releases it if it is still ours."""
+        lock_path = self._path(lock_name)
+        stop = threading.Event()
+        
+        def beat():
+            while not stop.wait(self.heartbeat_seconds):
+                try:
+                    os.utime(lock_path)
+                except FileNotFoundError:
+                    pass
+        
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self._take_lock(lock_path, token)
+    
+    def _read_shard(self, shard: int):
+        with open(self._path(f"shard-{shard:05d}.ndjson")) as f:
+            for line in f:
+                registry = NodeRegistry()
+                yield [intersection_from_record(record, registry) for record in json.loads(line)]
+    
+    def wait_for_partition(self, timeout: float = None, poll_seconds: float = 0.5):
+        """
+        Returns once partition.json exists, waiting while another worker holds a live
+        partition.lock. Raises RuntimeError if nobody is partitioning the batch (or the
+        partitioning worker died), TimeoutError after timeout seconds.
+        """
+        lock_path = self._path('partition.lock')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not os.path.exists(self._path('partition.json')):
+            lock = self._read_lock(lock_path)
+            # partition.json is written before the lock is released, so check it again
+            if lock is None or self._is_abandoned(lock_path, lock):
+                if os.path.exists(self._path('partition.json')):
+                    break
+                raise RuntimeError(f"Batch in {self.work_dir} has not been partitioned")
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Batch in {self.work_dir} is still being partitioned by {lock.get('worker')}")
+            time.sleep(poll_seconds)
+    
+    def run(self, partition_timeout: float = None) -> list[int]:
+        """
+        Processes every unfinished shard this worker can claim, returns the shards it completed.
+        Waits first if another worker is still partitioning the batch (see wait_for_partition).
+        """
+        self.wait_for_partition(timeout=partition_timeout)
+        completed = []
+        for shard in self.pending_shards():
+            lock_name = f"shard-{shard:05d}.lock"
+            token = self._claim(lock_name)
+            if token is None:
+                continue
+            with self._heartbeat(lock_name, token):
+                # Another worker may have finished it between listing and claiming
+                if self.is_done(shard):
+                    continue
+                started_at = time.time()
+                summary = self.process_shard(shard, self._read_shard(shard))
+                write_json_atomic(self._path(f"shard-{shard:05d}.done.json"), {
+                    'shard': shard,
+                    'worker': self.worker_id,
+                    'started_at': started_at,
+                    'finished_at': time.time(),
+                    'summary': summary
+                })
+                completed.append(shard)
+        return completed
+
+class _StageFailure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+class ProcessStage:
+    """
+    Marks a StagedPipeline stage as CPU work to run in worker processes instead of a thread.
+    Items and results cross process boundaries, so they must be picklable. Where the 'fork'
+    start method exists (Linux, macOS) the function itself may be a closure or lambda;
+    elsewhere the workers are spawned and it must be a picklable module-level function.
+    Args:
+        func: Stage function, called with one item
+        workers: Worker processes for this stage
+    """
+    def __init__(self, func, workers: int = 1):
+        self.func = func
+        self.workers = max(1, workers)
+
+def _process_stage_worker(func, connection):
+    # Runs in a worker process: answers each (item,) with (True, result) or (False, error), None stops it
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        try:
+            reply = (True, func(message[0]))
+        except BaseException as e:
+            reply = (False, e)
+        try:
+            connection.send(reply)
+        except Exception as e:  # result or exception is not picklable
+            connection.send((False, RuntimeError(f"Cannot return stage result: {e!r}")))
+
+class StagedPipeline:
+    """
+    Runs items through a sequence of stages with a bounded queue between stages, so while
+    item N is in the last stage item N+1 is in the one before it, and so on. Plain callables
+    run in a thread (for I/O); ProcessStage stages run in their own worker processes, so
+    CPU-bound stages use several cores. The workers are started in the calling thread before
+    any pipeline thread, so a forked worker never inherits a lock held by another thread of
+    the pipeline. Outputs come out in input order. An exception in any stage stops the
+    pipeline and is re-raised to the caller; closing the generator stops all stages.
+    Args:
+        stages: Callables or ProcessStage, each taking the previous stage's output
+        maxsize: Items each queue may hold before the stage feeding it blocks
+    """
+    _DONE = object()
+    _STOPPED = object()
+    
+    def __init__(self, stages: list, maxsize: int = 4):
+        self.stages = stages
+        self.maxsize = maxsize
+    
+    def run(self, items):
+        queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages) + 1)]
+        stop = threading.Event()
+        
+        # Both wait in short steps so every thread notices stop instead of blocking forever
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return self._STOPPED
+        
+        def feed():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        return
+                    put(queues[0], item)
+            except BaseException as e:
+                put(queues[0], _StageFailure(e))
+                return
+            put(queues[0], self._DONE)
+        
+        def work(stage, inbox, outbox):
+            while True:
+                item = get(inbox)
+                if item is self._STOPPED:
+                    return
+                if item is self._DONE or isinstance(item, _StageFailure):
+                    put(outbox, item)
+                    return
+                try:
+                    result = stage(item)
+                except BaseException as e:
+                    put(outbox, _StageFailure(e))
+                    return
+                put(outbox, result)
+        
+        # Items go to the workers round robin and results are read back in the same order, so
+        # the output keeps the input order; slots keeps at most two items per worker in flight
+        def send_to_workers(connections, inbox, sent, slots):
+            count = 0
+            while True:
+                item = get(inbox)
+                if item is self._STOPPED:
+                    return
+                if item is self._DONE or isinstance(item, _StageFailure):
+                    put(sent, item)
+                    return
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                try:
+                    connections[count % len(connections)].send((item,))
+                except BaseException as e:  # item not picklable, or the worker is gone
+                    put(sent, _StageFailure(e))
+                    return
+                put(sent, count)
+                count += 1
+        
+        def receive_from_workers(connections, sent, outbox, slots):
+            while True:
+                count = get(sent)
+                if count is self._STOPPED:
+                    return
+                if not isinstance(count, int):
+                    put(outbox, count)
+                    return
+                connection = connections[count % len(connections)]
+                try:
+                    while not connection.poll(0.1):
+                        if stop.is_set():
+                            return
+                    ok, result = connection.recv()
+                except (EOFError, OSError):
+                    if not stop.is_set():
+                        put(outbox, _StageFailure(RuntimeError("Stage worker process exited unexpectedly")))
+                    return
+                slots.release()
+                if not ok:
+                    put(outbox, _StageFailure(result))
+                    return
+                put(outbox, result)
+        
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        processes = []
+        threads = []
+        try:
+            # Start every worker process before the first thread
+            stage_connections = []
+            for stage in self.stages:
+                if not isinstance(stage, ProcessStage):
+                    stage_connections.append(None)
+                    continue
+                connections = []
+                for _ in range(stage.workers):
+                    connection, worker_connection = context.Pipe()
+                    process = context.Process(target=_process_stage_worker, args=(stage.func, worker_connection), daemon=True)
+                    process.start()
+                    worker_connection.close()
+                    processes.append((process, connection))
+                    connections.append(connection)
+                stage_connections.append(connections)
+            
+            threads.append(threading.Thread(target=feed, daemon=True))
+            for stage, connections, inbox, outbox in zip(self.stages, stage_connections, queues, queues[1:]):
+                if connections is None:
+                    threads.append(threading.Thread(target=work, args=(stage, inbox, outbox), daemon=True))
+                    continue
+                sent = queue.Queue()
+                slots = threading.Semaphore(2 * len(connections))
+                threads.append(threading.Thread(target=send_to_workers, args=(connections, inbox, sent, slots), daemon=True))
+                threads.append(threading.Thread(target=receive_from_workers, args=(connections, sent, outbox, slots), daemon=True))
+            for thread in threads:
+                thread.start()
+            
+            while True:
+                item = queues[-1].get()
+                if item is self._DONE:
+                    return
+                if isinstance(item, _StageFailure):
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+            # Stopping the workers first also frees a sender blocked writing to a busy worker
+            for process, _ in processes:
+                process.terminate()
+            for thread in threads:
+                thread.join()
+            for process, connection in processes:
+                process.join()
+                connection.close()
+
+def allocate_by_quadrant(intersection_list: list[Intersection], allocate) -> list[Intersection]:
+    """
+    Calls allocate(quadrant, intersections) once per quadrant, lowest quadrant (the -1 primary) first.
+    For an IntersectionTable it is called as allocate(quadrant, rows, table) with the quadrant's
+    row numbers, so no per-link objects are created.
+    """
+    if isinstance(intersection_list, IntersectionTable):
+        for quadrant, rows in intersection_list.rows_by_quadrant().items():
+            allocate(quadrant, rows, intersection_list)
+        return intersection_list
+    
+    quadrants = {}
+    for intersection in intersection_list:
+        try:
+            quadrants[intersection.quadrant_number].append(intersection)
+        except KeyError:
+            quadrants[intersection.quadrant_number] = [intersection]
+    for quadrant in sorted(quadrants):
+        allocate(quadrant, quadrants[quadrant])
+    return intersection_list
+
+def parse_intersection_line(line: str) -> list[Intersection]:
+    """Parses one line of a shard file (see ShardedBatchRunner) into an intersection list."""
+    registry = NodeRegistry()
+    return [intersection_from_record(record, registry) for record in json.loads(line)]
+
+def _json_sinks() -> list:
+    return [JsonSink()]
+
+def _export_with_new_sinks(intersection_list: list[Intersection], make_sinks) -> list:
+    return export_intersections(intersection_list, make_sinks())
+
+def run_quadrant_pipeline(sources, parse=parse_intersection_line, allocate=None, make_sinks=None, maxsize: int = 4,
+                          workers: int = None):
+    """
+    Ingest -> per-quadrant allocation -> export, pipelined across trees. Each stage runs in
+    its own worker processes (see ProcessStage), so allocate and make_sinks run in another
+    process: allocate's changes travel back with the intersection list, other side effects
+    stay in the worker. Sinks must produce picklable results (JsonSink, DotSink). Where worker
+    processes are spawned rather than forked, parse, allocate and make_sinks must be
+    picklable module-level functions.
+    Args:
+        sources: Iterable of inputs, e.g. the lines of a shard file
+        parse: Turns a source into an intersection list (None if sources already are lists)
+        allocate: Called per quadrant as in allocate_by_quadrant, None to skip the stage
+        make_sinks: Returns fresh export sinks for each tree, defaults to [JsonSink()]
+        maxsize: Trees buffered between two stages
+        workers: Worker processes per stage, defaults to the CPU count shared between the stages;
+            0 runs every stage in a thread of this process instead
+    Returns:
+        Generator of export_intersections results, one per source in input order
+    """
+    if make_sinks is None:
+        make_sinks = _json_sinks
+    # partial of module-level functions, so the stages can be pickled for spawned workers
+    stages = []
+    if parse is not None:
+        stages.append(parse)
+    if allocate is not None:
+        stages.append(partial(allocate_by_quadrant, allocate=allocate))
+    stages.append(partial(_export_with_new_sinks, make_sinks=make_sinks))
+    
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // len(stages))
+    if workers:
+        stages = [ProcessStage(stage, workers) for stage in stages]
+    return StagedPipeline(stages, maxsize).run(sources)
+
+BASIS_POINTS = 10_000
+RATIO_ROUNDING_MODES = ('half_even', 'half_up', 'down')
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+# Largest |numerator| whose value in basis points still fits in int64
+RATIO_NUMERATOR_LIMIT = INT64_MAX // BASIS_POINTS
+
+def _ratio_bps_numpy(numerators: array, denominators: array, rounding: str, zero_value):
+    """
+    ratio_bps on whole int64 columns with NumPy, same results as the Python loop.
+    Returns None when a value is outside the range this path handles exactly.
+    """
+    n = numpy.frombuffer(numerators, dtype=numpy.int64)
+    d = numpy.frombuffer(denominators, dtype=numpy.int64)
+    if len(n) and (n.min() < -RATIO_NUMERATOR_LIMIT or n.max() > RATIO_NUMERATOR_LIMIT or d.min() == INT64_MIN):
+        return None
+    zero = d == 0
+    if zero.any():
+        if zero_value is None:
+            raise ZeroDivisionError(f"Zero denominator in row {int(numpy.flatnonzero(zero)[0])}")
+        d = numpy.where(zero, 1, d)
+    
+    # Round the magnitude, then apply the sign, so rounding is symmetric around zero
+    divisor = numpy.abs(d)
+    quotient, remainder = numpy.divmod(numpy.abs(n) * BASIS_POINTS, divisor)
+    if rounding != 'down':
+        # remainder > divisor - remainder instead of 2 * remainder > divisor, which could overflow
+        other = divisor - remainder
+        round_up = remainder > other
+        tie = (remainder == other) & (remainder != 0)
+        round_up |= tie if rounding == 'half_up' else tie & (quotient & 1 == 1)
+        quotient += round_up
+    quotient = numpy.where((n < 0) != (d < 0), -quotient, quotient)
+    if zero_value is not None:
+        quotient[zero] = zero_value
+    
+    result = array('q')
+    result.frombytes(quotient.astype(numpy.int64, copy=False).tobytes())
+    return result
+
+def ratio_bps(numerators, denominators, rounding: str = 'half_even', zero_value: int = None) -> array:
+    """
+    Element-wise numerator / denominator in basis points (10000 = 100%) using exact integer
+    arithmetic, so a row's result never depends on the batch it was computed in. With NumPy
+    installed whole columns are computed at once; without it, or when a numerator exceeds
+    RATIO_NUMERATOR_LIMIT, each row is computed with Python integers.
+    Args:
+        numerators: int64 column (array('q') or any sequence of ints)
+        denominators: int64 column of the same length
+        rounding: 'half_even' (ties to even), 'half_up' (ties away from zero) or 'down' (towards zero)
+        zero_value: Result for a zero denominator, None to raise ZeroDivisionError
+    Returns:
+        array('q') of ratios in basis points
+    Raises:
+        OverflowError: An input, zero_value or a result does not fit in int64
+    """
+    if rounding not in RATIO_ROUNDING_MODES:
+        raise ValueError(f"Unknown rounding {rounding}, expected one of {', '.join(RATIO_ROUNDING_MODES)}")
+    if zero_value is not None and not INT64_MIN <= zero_value <= INT64_MAX:
+        raise OverflowError(f"zero_value {zero_value} does not fit in int64")
+    # Converting to array('q') rejects inputs outside the int64 range
+    numerators = numerators if isinstance(numerators, array) and numerators.typecode == 'q' else array('q', numerators)
+    denominators = denominators if isinstance(denominators, array) and denominators.typecode == 'q' else array('q', denominators)
+    if len(numerators) != len(denominators):
+        raise ValueError(f"Got {len(numerators)} numerators and {len(denominators)} denominators")
+    
+    if numpy is not None:
+        result = _ratio_bps_numpy(numerators, denominators, rounding, zero_value)
+        if result is not None:
+            return result
+    
+    half_up = rounding == 'half_up'
+    truncate = rounding == 'down'
+    results = []
+    append = results.append
+    for row, (numerator, denominator) in enumerate(zip(numerators, denominators)):
+        if not denominator:
+            if zero_value is None:
+                raise ZeroDivisionError(f"Zero denominator in row {row}")
+            append(zero_value)
+            continue
+        # Round the magnitude, then apply the sign, so rounding is symmetric around zero
+        divisor = abs(denominator)
+        quotient, remainder = divmod(abs(numerator) * BASIS_POINTS, divisor)
+        if remainder and not truncate:
+            twice = 2 * remainder
+            if twice > divisor or (twice == divisor and (half_up or quotient & 1)):
+                quotient += 1
+        append(-quotient if (numerator < 0) != (denominator < 0) else quotient)
+    
+    try:
+        return array('q', results)
+    except OverflowError:
+        raise OverflowError("Ratio in basis points does not fit in int64") from None
+
+def compute_ratio_columns(ratios: dict, rounding: str = 'half_even', zero_value: int = None) -> dict:
+    """
+    Computes several ratio columns for a whole book at once, e.g.
+    compute_ratio_columns({'lbvr1': (loans, bank_values_1), 'lmvr1': (loans, market_values_1), ...}).
+    The result can be passed straight to ProductResultWriter.add_columns with the text columns.
+    Args:
+        ratios: Column name -> (numerators, denominators)
+        rounding: See ratio_bps
+        zero_value: See ratio_bps
+    Returns:
+        Column name -> array('q') of ratios in basis points
+    """
+    return {
+        name: ratio_bps(numerators, denominators, rounding, zero_value)
+        for name, (numerators, denominators) in ratios.items()
+    }
+
+NDJSON_KEY_FIELDS = ('record', 'quadrant', 'position')
+
+def _ndjson_key(record: dict) -> tuple:
+    # Nodes sort by id and links by their position in the intersection list, quadrant by quadrant
+    if record['record'] == 'node':
+        return (record['quadrant'], 0, record['id'])
+    return (record['quadrant'], 1, record['position'])
+
+def _sorted_ndjson_records(path: str, presorted: bool, chunk_size: int, fan_in: int, run_prefix: str, stack: ExitStack):
+    """
+    Yields (key, record) from an NdjsonSink file in key order, external-sorting it unless
+    presorted. At most fan_in sort runs are open at a time.
+    """
+    f = stack.enter_context(open(path))
+    records = (json.loads(line) for line in f if line.strip())
+    if presorted:
+        last_key = None
+        for record in records:
+            key = _ndjson_key(record)
+            if last_key is not None and key < last_key:
+                raise ValueError(f"{path} is not sorted by quadrant and node id, compare it with presorted=False")
+            last_key = key
+            yield key, record
+        return
+    
+    # Sort chunks of chunk_size records into run files, then merge the runs
+    runs = []
+    while True:
+        chunk = sorted(((_ndjson_key(record), record) for record in islice(records, chunk_size)), key=itemgetter(0))
+        if not chunk:
+            break
+        run_path = f"{run_prefix}-{len(runs)}.ndjson"
+        with open(run_path, 'w') as run:
+            run.writelines(json.dumps([key, record]) + "\n" for key, record in chunk)
+        runs.append(run_path)
+        del chunk
+    
+    def read_run(run_path):
+        with open(run_path) as run:
+            for line in run:
+                key, record = json.loads(line)
+                yield tuple(key), record
+    
+    # Merge fan_in runs at a time into longer runs until one merge of at most fan_in is left
+    generation = 0
+    while len(runs) > fan_in:
+        merged = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start:start + fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            run_path = f"{run_prefix}-merged-{generation}-{len(merged)}.ndjson"
+            with open(run_path, 'w') as run:
+                run.writelines(
+                    json.dumps([key, record]) + "\n"
+                    for key, record in heapq.merge(*(read_run(group_path) for group_path in group), key=itemgetter(0)))
+            for group_path in group:
+                os.remove(group_path)
+            merged.append(run_path)
+        runs = merged
+        generation += 1
+    yield from heapq.merge(*(read_run(run_path) for run_path in runs), key=itemgetter(0))
+
+def _indexed_links(sorted_records):
+    # compare_json_outputs compares links by index within the quadrant, so renumber them per quadrant
+    quadrant = None
+    index = 0
+    for key, record in sorted_records:
+        if key[1] == 1:
+            if key[0] != quadrant:
+                quadrant, index = key[0], 0
+            key = (key[0], 1, index)
+            index += 1
+        yield key, record
+
+def compare_ndjson_outputs(path1: str, path2: str, out, max_content_chars: int = 1000,
+                           presorted: bool = False, chunk_size: int = 100_000, tmp_dir: str = None,
+                           merge_fan_in: int = 64) -> int:
+    """
+    Streaming version of compare_json_outputs for two NdjsonSink exports. Records are matched
+    quadrant by quadrant, nodes by id and links by index, and each difference is written to out
+    as one JSON line as soon as it is found. Memory stays bounded by chunk_size records per file,
+    and open files by merge_fan_in sort runs per file, however large the inputs are.
+    Args:
+        path1: First NDJSON export
+        path2: Second NDJSON export
+        out: Text stream the differences are written to
+        max_content_chars: Longest 'content' written for a record found in only one file
+        presorted: Inputs are already ordered by quadrant, then nodes by id, then links by position
+        chunk_size: Records sorted in memory at a time when the inputs are not presorted
+        tmp_dir: Where the sort runs are written, the system temp directory if None
+        merge_fan_in: Sort runs merged at once; more runs are merged in several passes
+    Returns:
+        Number of differences written
+    """
+    def content(record):
+        text = json.dumps(record)
+        if len(text) <= max_content_chars:
+            return record
+        return {'truncated': text[:max_content_chars]}
+    
+    def strip(record):
+        return {k: v for k, v in record.items() if k not in NDJSON_KEY_FIELDS}
+    
+    def difference(key, **fields):
+        entry = {'quadrant': key[0], 'kind': 'node' if key[1] == 0 else 'link'}
+        entry['id' if key[1] == 0 else 'index'] = key[2]
+        entry.update(fields)
+        out.write(json.dumps(entry) + "\n")
+    
+    if merge_fan_in < 2:
+        raise ValueError(f"merge_fan_in must be at least 2, got {merge_fan_in}")
+    count = 0
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as sort_dir, ExitStack() as stack:
+        first = _indexed_links(_sorted_ndjson_records(path1, presorted, chunk_size, merge_fan_in, os.path.join(sort_dir, 'first'), stack))
+        second = _indexed_links(_sorted_ndjson_records(path2, presorted, chunk_size, merge_fan_in, os.path.join(sort_dir, 'second'), stack))
+        a = next(first, None)
+        b = next(second, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a[0] < b[0]):
+                difference(a[0], status='Only in first dictionary', content=content(strip(a[1])))
+                count += 1
+                a = next(first, None)
+            elif a is None or b[0] < a[0]:
+                difference(b[0], status='Only in second dictionary', content=content(strip(b[1])))
+                count += 1
+                b = next(second, None)
+            else:
+                record1, record2 = strip(a[1]), strip(b[1])
+                if record1 != record2:
+                    if a[0][1] == 0:
+                        difference(a[0], differences={
+                            k: {'first_dict': record1.get(k), 'second_dict': record2.get(k)}
+                            for k in record1.keys() | record2.keys() if record1.get(k) != record2.get(k)
+                        })
+                    else:
+                        difference(a[0], differences={'first_dict': record1, 'second_dict': record2})
+                    count += 1
+                a = next(first, None)
+                b = next(second, None)
+    return count
+
 # Example usage
 dict1 = output_json(intersection_list1)
 dict2 = output_json(intersection_list2)
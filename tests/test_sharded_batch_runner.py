@@ -0,0 +1,215 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lcc-objects.py')
+
+try:
+    import graphviz  # noqa: F401, needed by lcc-objects.py
+except ImportError:
+    graphviz = None
+
+
+def load_lcc_objects():
+    # lcc-objects.py is a script (its name is not importable and it runs example code), so
+    # execute it into a module and keep the definitions even if the example code fails
+    module = types.ModuleType('lcc_objects')
+    module.__file__ = MODULE_PATH
+    sys.modules['lcc_objects'] = module
+    with open(MODULE_PATH) as f, redirect_stdout(StringIO()):
+        try:
+            exec(compile(f.read(), MODULE_PATH, 'exec'), module.__dict__)
+        except NameError:
+            pass
+    return module
+
+
+@unittest.skipIf(graphviz is None, "graphviz is not installed")
+class ShardedBatchRunnerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.lcc = load_lcc_objects()
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.processed = []
+
+    def make_lists(self, count):
+        lcc = self.lcc
+        lists = []
+        for i in range(count):
+            root = lcc.Node(f"root-{i}", 'PRODUCT', 10, 10, 10, 10, 10, 10)
+            child = lcc.Node(f"child-{i}", 'CHARGE', 5, 5, 5, 5, 5, 5)
+            lists.append([lcc.Intersection(root, child, 1, 1, 1, 1, 1)])
+        return lists
+
+    def process_shard(self, shard, intersection_lists):
+        count = sum(1 for _ in intersection_lists)
+        self.processed.append(shard)
+        return {'lists': count}
+
+    def runner(self, **kwargs):
+        kwargs.setdefault('num_shards', 4)
+        return self.lcc.ShardedBatchRunner(self.work_dir, self.process_shard, **kwargs)
+
+    def lock_path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def write_lock(self, name, worker, token='other'):
+        with open(self.lock_path(name), 'w') as f:
+            json.dump({'worker': worker, 'token': token, 'claimed_at': time.time()}, f)
+
+    def dead_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def test_runs_every_shard_once(self):
+        runner = self.runner()
+        self.assertTrue(runner.partition(self.make_lists(20)))
+        self.assertFalse(runner.partition(self.make_lists(20)))
+        self.assertEqual(sorted(runner.run()), [0, 1, 2, 3])
+        self.assertEqual(runner.pending_shards(), [])
+        self.assertEqual(runner.run(), [])
+        total = 0
+        for shard in range(4):
+            with open(self.lock_path(f"shard-{shard:05d}.done.json")) as f:
+                total += json.load(f)['summary']['lists']
+        self.assertEqual(total, 20)
+        self.assertEqual([name for name in os.listdir(self.work_dir) if name.endswith(('.lock', '.tmp', '.taken'))], [])
+
+    def test_resumes_after_failed_shard(self):
+        runner = self.runner()
+        runner.partition(self.make_lists(20))
+        failing = []
+
+        def fail_once(shard, intersection_lists):
+            if not failing:
+                failing.append(shard)
+                raise RuntimeError("crash")
+            return self.process_shard(shard, intersection_lists)
+
+        runner.process_shard = fail_once
+        with self.assertRaises(RuntimeError):
+            runner.run()
+        self.assertIn(failing[0], runner.pending_shards())
+        self.assertFalse(os.path.exists(self.lock_path(f"shard-{failing[0]:05d}.lock")))
+        pending = runner.pending_shards()
+        self.assertEqual(sorted(runner.run()), pending)
+        self.assertEqual(runner.pending_shards(), [])
+
+    def test_empty_list_is_partitioned(self):
+        runner = self.runner()
+        self.assertTrue(runner.partition([[]] + self.make_lists(3)))
+        self.assertEqual(runner.shard_of([]), 0)
+        runner.run()
+        with open(self.lock_path('partition.json')) as f:
+            self.assertEqual(sum(json.load(f)['lists_per_shard']), 4)
+
+    def test_failed_partition_leaves_no_temp_files(self):
+        def broken_input():
+            yield from self.make_lists(3)
+            raise ValueError("bad input")
+
+        runner = self.runner()
+        with self.assertRaises(ValueError):
+            runner.partition(broken_input())
+        self.assertEqual(os.listdir(self.work_dir), [])
+        self.assertTrue(runner.partition(self.make_lists(3)))
+
+    def test_reclaims_lock_of_dead_worker(self):
+        runner = self.runner()
+        runner.partition(self.make_lists(20))
+        self.write_lock('shard-00000.lock', f"{runner.host}:{self.dead_pid()}")
+        self.assertEqual(sorted(runner.run()), [0, 1, 2, 3])
+
+    def test_keeps_lock_of_live_worker(self):
+        runner = self.runner()
+        runner.partition(self.make_lists(20))
+        self.write_lock('shard-00000.lock', f"{runner.host}:{os.getppid()}")
+        self.assertEqual(sorted(runner.run()), [1, 2, 3])
+        self.assertTrue(os.path.exists(self.lock_path('shard-00000.lock')))
+
+    def test_reclaims_stale_lock_from_other_host(self):
+        runner = self.runner(stale_lock_seconds=60)
+        runner.partition(self.make_lists(20))
+        self.write_lock('shard-00000.lock', "other-host:1234")
+        self.assertEqual(sorted(runner.run()), [1, 2, 3])
+        old = time.time() - 120
+        os.utime(self.lock_path('shard-00000.lock'), (old, old))
+        self.assertEqual(runner.run(), [0])
+
+    def test_heartbeat_keeps_lock_fresh(self):
+        runner = self.runner(stale_lock_seconds=0.3, heartbeat_seconds=0.05)
+        other = self.runner(stale_lock_seconds=0.3)
+        other.host = 'other-host'  # judged by age only, like a worker on another machine
+        token = runner._claim('shard-00000.lock')
+        self.assertIsNotNone(token)
+        with runner._heartbeat('shard-00000.lock', token):
+            time.sleep(0.6)
+            self.assertIsNone(other._claim('shard-00000.lock'))
+        self.assertFalse(os.path.exists(self.lock_path('shard-00000.lock')))
+
+    def test_release_keeps_lock_claimed_by_another_worker(self):
+        runner = self.runner()
+        token = runner._claim('shard-00000.lock')
+        with runner._heartbeat('shard-00000.lock', token):
+            # Our lock was reclaimed and another worker holds the shard now
+            os.remove(self.lock_path('shard-00000.lock'))
+            self.write_lock('shard-00000.lock', "other-host:1234", token='theirs')
+        with open(self.lock_path('shard-00000.lock')) as f:
+            self.assertEqual(json.load(f)['token'], 'theirs')
+
+    def test_take_lock_puts_back_foreign_lock(self):
+        runner = self.runner()
+        self.write_lock('shard-00000.lock', "other-host:1234", token='theirs')
+        self.assertFalse(runner._take_lock(self.lock_path('shard-00000.lock'), 'ours'))
+        with open(self.lock_path('shard-00000.lock')) as f:
+            self.assertEqual(json.load(f)['token'], 'theirs')
+        self.assertTrue(runner._take_lock(self.lock_path('shard-00000.lock'), 'theirs'))
+        self.assertFalse(os.path.exists(self.lock_path('shard-00000.lock')))
+
+    def test_run_waits_for_partitioning_worker(self):
+        partitioner = self.runner()
+        waiter = self.runner()
+        started = threading.Event()
+
+        def slow_input():
+            started.set()
+            time.sleep(0.3)
+            yield from self.make_lists(20)
+
+        thread = threading.Thread(target=partitioner.partition, args=(slow_input(),))
+        thread.start()
+        try:
+            started.wait()
+            # partition() gives up while the lock is held, run() waits for it
+            self.assertFalse(waiter.partition(self.make_lists(20)))
+            self.assertEqual(sorted(waiter.run()), [0, 1, 2, 3])
+        finally:
+            thread.join()
+
+    def test_run_without_partition_raises(self):
+        runner = self.runner()
+        with self.assertRaises(RuntimeError):
+            runner.run()
+        self.write_lock('partition.lock', f"{runner.host}:{self.dead_pid()}")
+        with self.assertRaises(RuntimeError):
+            runner.run()
+        self.write_lock('partition.lock', f"{runner.host}:{os.getppid()}")
+        with self.assertRaises(TimeoutError):
+            runner.run(partition_timeout=0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()